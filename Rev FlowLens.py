@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
 import re
+import csv
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import plotly.express as px
 
 # ========== 页面设置 ==========
@@ -12,79 +16,171 @@ st.title("📊 Custom Attribution Model")
 uploaded_file = st.file_uploader("Upload original CSV file", type=["csv"])
 
 # ========== 工具函数 ==========
+paid_keywords = ["cpc", "paid", "shopping", "summersale"]
+PAID_PATTERN = "|".join(paid_keywords)
+COLUMN_NAMES = [
+    "Session default channel group",
+    "Session source / medium",
+    "First user source / medium",
+    "Sessions",
+    "Total users",
+    "Add to carts",
+    "Checkouts",
+    "Purchases",
+    "Total revenue",
+]
+_NON_BLANK = re.compile(rb"\S")
+_SPACE_TBL = str.maketrans({'\u00A0': ' ', '\u2007': ' ', '\u202F': ' '})
+
 def normalize_space_series(s: pd.Series) -> pd.Series:
     """Clean spaces and slashes"""
     return (
         s.astype(str)
-         .str.replace('\u00A0', ' ', regex=False)
-         .str.replace('\u2007', ' ', regex=False)
-         .str.replace('\u202F', ' ', regex=False)
+         .str.translate(_SPACE_TBL)
          .str.replace(r'\s+', ' ', regex=True)
          .str.strip()
     )
 
-def split_source_medium(col: pd.Series, src_name: str, med_name: str) -> pd.DataFrame:
-    """Split 'source / medium'"""
+def split_source_medium(col: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """Split 'source / medium' into (source, medium)"""
     col_norm = normalize_space_series(col)
     sp = col_norm.str.split(r'\s*[\/／]\s*', n=1, regex=True, expand=True)
     if sp.shape[1] == 1:
         sp[1] = None
-    out = pd.DataFrame({src_name: sp[0], med_name: sp[1]}, index=col.index)
-    no_sep = ~col_norm.str.contains(r'[\/／]', regex=True)
-    out.loc[no_sep, [src_name, med_name]] = "Unrecognized"
-    out[src_name] = out[src_name].fillna("Unrecognized")
-    out[med_name] = out[med_name].fillna("Unrecognized")
-    return out
+    has_sep = col_norm.str.contains(r'[\/／]', regex=True).to_numpy()
+    src = np.where(has_sep, sp[0].fillna("Unrecognized").to_numpy(), "Unrecognized")
+    med = np.where(has_sep, sp[1].fillna("Unrecognized").to_numpy(), "Unrecognized")
+    return src, med
+
+@st.cache_data
+def build_pie(df_small: pd.DataFrame, names: str, values: str, title: str, palette: list[str]):
+    """Build a revenue pie chart"""
+    fig = px.pie(
+        df_small,
+        names=names,
+        values=values,
+        title=title,
+        hole=0.0,
+        color_discrete_sequence=palette
+    )
+    fig.update_traces(textinfo="none", hovertemplate="%{label}<br>Revenue: %{value:,.0f}<br>Share: %{percent}")
+    fig.update_layout(title_font_size=16)
+    return fig
+
+@st.cache_data
+def _csv_bytes(df: pd.DataFrame) -> bytes:
+    """Serialize to UTF-8 CSV with a BOM (Excel-friendly) via pyarrow"""
+    sink = io.BytesIO()
+    sink.write(b"\xef\xbb\xbf")
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), sink)
+    return sink.getvalue()
+
+def _header_span(data: bytes, header: int = 7) -> tuple[int, int]:
+    """Byte range of the header row; blank lines are not counted (same as pandas header=)"""
+    pos, seen = 0, 0
+    while pos < len(data):
+        end = data.find(b"\n", pos)
+        end = len(data) if end == -1 else end + 1
+        if data[pos:end].strip():
+            if seen == header:
+                return pos, end
+            seen += 1
+        pos = end
+    return len(data), len(data)
+
+def _read_table(data: bytes) -> pa.Table:
+    """Parse the data rows below the header, keeping only the first 9 columns"""
+    start, end = _header_span(data)
+    if not _NON_BLANK.search(data, end):
+        # Nothing below the header (pyarrow would fail with "Empty CSV file")
+        return pa.table({})
+    n_cols = len(next(csv.reader([data[start:end].decode("utf-8", errors="ignore")]), []))
+    col_ids = [f"f{i}" for i in range(n_cols)]
+    return pacsv.read_csv(
+        pa.BufferReader(pa.py_buffer(data).slice(end)),
+        read_options=pacsv.ReadOptions(column_names=col_ids),
+        convert_options=pacsv.ConvertOptions(include_columns=col_ids[:len(COLUMN_NAMES)]),
+    )
+
+def _read_table_pandas(data: bytes) -> pa.Table:
+    """Fallback parser: pads short rows with NaN and drops undecodable bytes"""
+    df = pd.read_csv(
+        io.BytesIO(data), header=7, encoding="utf-8", encoding_errors="ignore", dtype_backend="pyarrow"
+    )
+    df = df.iloc[:, :len(COLUMN_NAMES)]
+    df.columns = [f"f{i}" for i in range(df.shape[1])]
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+@st.cache_data
+def load_and_clean(file_bytes: bytes) -> tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """Read the raw export and build the cleaned DataFrame plus per-row ad-channel weights"""
+    # ---------- 1. Read and preprocess ----------
+    try:
+        table = _read_table(file_bytes)
+        # pyarrow infers binary columns for invalid UTF-8 rather than failing
+        if any(pa.types.is_binary(t) for t in table.schema.types):
+            raise pa.ArrowInvalid("invalid UTF-8")
+    except pa.ArrowInvalid:
+        # Invalid UTF-8 or short rows, which pyarrow cannot pad: use pandas so
+        # every data row is kept and the positional summary-row drop stays correct
+        table = _read_table_pandas(file_bytes)
+
+    if table.num_rows == 0:
+        return pd.DataFrame(columns=COLUMN_NAMES), np.zeros(0), np.zeros(0)
+
+    # Drop 9th line (summary)
+    if table.num_rows > 8:
+        table = pa.concat_tables([table.slice(0, 8), table.slice(9)])
+
+    # ---------- 2. Rename columns ----------
+    table = table.rename_columns(COLUMN_NAMES)
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
+
+    df["Total revenue"] = pd.to_numeric(df["Total revenue"], errors="coerce").astype("float64").fillna(0)
+
+    # ---------- 3. Split sources ----------
+    # Process both columns in one pass, then slice the result back in half
+    n = len(df)
+    combined = pd.concat(
+        [df["Session source / medium"], df["First user source / medium"]], ignore_index=True
+    )
+    src, med = split_source_medium(combined)
+    df["source1"], df["medium1"] = src[:n], med[:n]
+    df["source2"], df["medium2"] = src[n:], med[n:]
+
+    # Arrow-backed strings so .str ops below run on pyarrow compute kernels
+    sm_cols = ["source1", "medium1", "source2", "medium2"]
+    df[sm_cols] = df[sm_cols].astype("string[pyarrow]")
+
+    # ---------- 4. Paid or Non-paid ----------
+    m1 = df["medium1"].str.lower()
+    m2 = df["medium2"].str.lower()
+    has_m1 = m1.str.contains(PAID_PATTERN, na=False).to_numpy(dtype=bool)
+    has_m2 = m2.str.contains(PAID_PATTERN, na=False).to_numpy(dtype=bool)
+    is_paid = has_m1 | has_m2
+    is_unrecognized = m1.eq("unrecognized") & m2.eq("unrecognized")
+
+    df["Paid or Non-paid"] = np.where(
+        is_unrecognized, "Unrecognized", np.where(is_paid, "Paid", "Non-paid")
+    )
+
+    # Split revenue 50/50 when both mediums are paid, otherwise credit the paid one.
+    # Non-paid / Unrecognized rows match no keyword, so they get zero weight.
+    weight1 = np.where(has_m1 & has_m2, 0.5, has_m1.astype(float))
+    weight2 = np.where(has_m1 & has_m2, 0.5, has_m2.astype(float))
+
+    return df, weight1, weight2
 
 # ========== 主逻辑 ==========
 if uploaded_file is not None:
     try:
-        # ---------- 1. Read and preprocess ----------
-        raw_text = uploaded_file.getvalue().decode("utf-8", errors="ignore").splitlines()
-        csv_buffer = io.StringIO("\n".join(raw_text))
-        df = pd.read_csv(csv_buffer, header=7)
-
-        # Drop 9th line (summary)
-        if 8 in df.index:
-            df = df.drop(index=8)
-
-        # Keep first 9 columns
-        if df.shape[1] > 9:
-            df = df.iloc[:, :9]
-
-        # ---------- 2. Rename columns ----------
-        rename_map = {
-            df.columns[0]: "Session default channel group",
-            df.columns[1]: "Session source / medium",
-            df.columns[2]: "First user source / medium",
-            df.columns[3]: "Sessions",
-            df.columns[4]: "Total users",
-            df.columns[5]: "Add to carts",
-            df.columns[6]: "Checkouts",
-            df.columns[7]: "Purchases",
-            df.columns[8]: "Total revenue"
-        }
-        df.rename(columns=rename_map, inplace=True)
-
-        # ---------- 3. Split sources ----------
-        sm1 = split_source_medium(df["Session source / medium"], "source1", "medium1")
-        sm2 = split_source_medium(df["First user source / medium"], "source2", "medium2")
-        df = pd.concat([df, sm1, sm2], axis=1)
-
-        # ---------- 4. Paid or Non-paid ----------
-        paid_keywords = ["cpc", "paid", "shopping", "summersale"]
-
-        def judge_paid(row):
-            m1 = str(row["medium1"]).lower()
-            m2 = str(row["medium2"]).lower()
-            if m1 == "unrecognized" and m2 == "unrecognized":
-                return "Unrecognized"
-            elif any(k in m1 for k in paid_keywords) or any(k in m2 for k in paid_keywords):
-                return "Paid"
-            else:
-                return "Non-paid"
-
-        df["Paid or Non-paid"] = df.apply(judge_paid, axis=1)
+        # ---------- 1-4. Read, rename, split and classify ----------
+        df, weight1, weight2 = load_and_clean(uploaded_file.getvalue())
+
+        # Nothing to chart or export
+        if df.empty or df["Paid or Non-paid"].eq("Unrecognized").all():
+            st.warning("⚠️ No recognizable source / medium rows found in the uploaded file.")
+            st.stop()
 
         # ---------- 5. Display cleaned data ----------
         st.success("✅ Data cleaned successfully! Preview below:")
@@ -100,63 +196,52 @@ if uploaded_file is not None:
         mother_group = mother_group[mother_group["Paid or Non-paid"] != "Unrecognized"]
 
         with col1:
-            fig1 = px.pie(
-                mother_group,
-                names="Paid or Non-paid",
-                values="Total revenue",
-                title="Paid vs Non-paid",
-                hole=0.0,
-                color_discrete_sequence=px.colors.qualitative.Set2
+            fig1 = build_pie(
+                mother_group, "Paid or Non-paid", "Total revenue", "Paid vs Non-paid",
+                px.colors.qualitative.Set2
             )
-            fig1.update_traces(textinfo="none", hovertemplate="%{label}<br>Revenue: %{value:,.0f}<br>Share: %{percent}")
-            fig1.update_layout(title_font_size=16)
             st.plotly_chart(fig1, use_container_width=True)
 
         # Child chart: Ad channels (only paid)
-        paid_df = df[df["Paid or Non-paid"] == "Paid"].copy()
-        revenue_alloc = {}
-
-        for _, row in paid_df.iterrows():
-            total_rev = float(row["Total revenue"]) if not pd.isna(row["Total revenue"]) else 0
-            m1, m2 = str(row["medium1"]).lower(), str(row["medium2"]).lower()
-            s1, s2 = row["source1"], row["source2"]
-
-            has_m1 = any(k in m1 for k in paid_keywords)
-            has_m2 = any(k in m2 for k in paid_keywords)
-
-            if has_m1 and has_m2:
-                revenue_alloc[s1] = revenue_alloc.get(s1, 0) + total_rev * 0.5
-                revenue_alloc[s2] = revenue_alloc.get(s2, 0) + total_rev * 0.5
-            elif has_m1 and not has_m2:
-                revenue_alloc[s1] = revenue_alloc.get(s1, 0) + total_rev
-            elif has_m2 and not has_m1:
-                revenue_alloc[s2] = revenue_alloc.get(s2, 0) + total_rev
-
-        if len(revenue_alloc) == 0:
+        # Scatter-add weighted revenue into one slot per ad channel
+        keep1, keep2 = weight1 > 0, weight2 > 0
+        all_channels = pd.concat(
+            [df["source1"][keep1], df["source2"][keep2]], ignore_index=True
+        )
+        rev = df["Total revenue"].to_numpy()
+        weighted_rev = np.concatenate([(rev * weight1)[keep1], (rev * weight2)[keep2]])
+        codes, uniques = pd.factorize(all_channels, sort=False)
+        revenue_alloc = np.zeros(len(uniques))
+        np.add.at(revenue_alloc, codes, weighted_rev)
+
+        if len(uniques) == 0:
             st.warning("⚠️ No valid paid channels or revenue = 0.")
         else:
-            right_df = pd.DataFrame(list(revenue_alloc.items()), columns=["Ad Channel", "Total revenue"])
-            right_df = right_df.sort_values(by="Total revenue", ascending=False)
+            right_df = pd.DataFrame({"Ad Channel": uniques, "Total revenue": revenue_alloc})
+            # Top 20 channels; the rest go into one remainder slice so shares still add up
+            top_df = right_df.nlargest(20, "Total revenue")
+            n_rest = len(right_df) - len(top_df)
+            if n_rest > 0:
+                other_rev = right_df["Total revenue"].sum() - top_df["Total revenue"].sum()
+                # Counted label so it can't collide with a real source named "Other"
+                other_label = f"Other ({n_rest} channels)"
+                top_df = pd.concat(
+                    [top_df, pd.DataFrame({"Ad Channel": [other_label], "Total revenue": [other_rev]})],
+                    ignore_index=True
+                )
+            right_df = top_df
 
             with col2:
-                fig2 = px.pie(
-                    right_df,
-                    names="Ad Channel",
-                    values="Total revenue",
-                    title="Ad Channels",
-                    hole=0.0,
-                    color_discrete_sequence=px.colors.qualitative.Pastel
+                fig2 = build_pie(
+                    right_df, "Ad Channel", "Total revenue", "Ad Channels",
+                    px.colors.qualitative.Pastel
                 )
-                fig2.update_traces(textinfo="none", hovertemplate="%{label}<br>Revenue: %{value:,.0f}<br>Share: %{percent}")
-                fig2.update_layout(title_font_size=16)
                 st.plotly_chart(fig2, use_container_width=True)
 
         # ---------- 7. Download cleaned CSV ----------
-        output = io.BytesIO()
-        df.to_csv(output, index=False, encoding="utf-8-sig")
         st.download_button(
             label="📥 Download cleaned CSV",
-            data=output.getvalue(),
+            data=lambda: _csv_bytes(df),
             file_name="cleaned_data.csv",
             mime="text/csv",
         )